@@ -0,0 +1,236 @@
+"""
+Loading many shapes: a prefetching dataset loader
+=================================================
+
+This notebook shows how to iterate over a large collection of shape files without
+waiting on the disk and on the VTK parser between two registrations.
+
+- Wrap a list of files in a `ShapeDataset`
+- Decode (and preprocess) the files in a background thread pool with bounded prefetch
+- Get the shapes back in order, or as soon as they are ready
+"""
+
+# %% [markdown]
+# Create a collection of shapes
+# -----------------------------
+#
+# We write randomly rotated copies of the Stanford bunny (35k points) in a temporary folder, to play
+# the role of a directory with thousands of `.ply`/`.vtk` files.
+
+# %%
+import os
+import tempfile
+import time
+
+import pyvista as pv
+import torch
+from pyvista import examples
+
+import skshapes as sks
+
+n_files = 16
+
+mesh = sks.PolyData(examples.download_bunny())
+folder = tempfile.mkdtemp()
+
+torch.manual_seed(0)
+files = []
+for i in range(n_files):
+    # Random rotation and scaling. The Q factor of the QR decomposition of a gaussian matrix is
+    # orthogonal, its determinant is set to +1 by flipping a column, to avoid mirror images.
+    q, _ = torch.linalg.qr(torch.randn(3, 3))
+    q[:, 0] *= torch.sign(torch.linalg.det(q))
+    shape = sks.PolyData(
+        points=(1 + torch.rand(1)) * mesh.points @ q.T,
+        triangles=mesh.triangles,
+    )
+    filename = os.path.join(folder, f"mesh{i:03d}.vtk")
+    shape.save(filename)
+    files.append(filename)
+
+print(f"{len(files)} files written in {folder}")
+
+# %% [markdown]
+# The `ShapeDataset` and `ShapeLoader` classes
+# --------------------------------------------
+#
+# - `ShapeDataset` maps an index to a `PolyData`, read from a file and optionally preprocessed
+# - `ShapeLoader` runs `ShapeDataset.__getitem__` in a pool of workers, with at most `prefetch`
+#   shapes decoded or being decoded. A new file is submitted only when the consumer asks for the
+#   next shape, so at most `prefetch` shapes are held by the loader, in addition to the one being
+#   used. With `ordered=False`, shapes are yielded as they are ready.
+#
+# Reading files with VTK releases the GIL for most of the work, so a thread pool is enough.
+# A `concurrent.futures.ProcessPoolExecutor` can be passed as `executor` if the preprocessing is
+# heavy python code. In this case, the worker processes must be able to import `ShapeDataset` and
+# `preprocess`: with the spawn start method (the default on macOS), classes and functions defined in a
+# notebook or in this script cannot be unpickled by the workers, and must be moved to an importable
+# module.
+
+# %%
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class ShapeDataset:
+    """A collection of shape files, read as `PolyData` with an optional preprocessing."""
+
+    def __init__(self, files, preprocess=None):
+        self.files = list(files)
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        shape = sks.PolyData(self.files[i])
+        if self.preprocess is not None:
+            shape = self.preprocess(shape)
+        return shape
+
+
+class ShapeLoader:
+    """Iterate over a `ShapeDataset`, loading the shapes in a pool of workers."""
+
+    def __init__(
+        self, dataset, n_workers=4, prefetch=8, ordered=True, executor=ThreadPoolExecutor
+    ):
+        if prefetch < 1:
+            raise ValueError("prefetch must be a positive integer")
+        self.dataset = dataset
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.ordered = ordered
+        self.executor = executor
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        executor = self.executor(max_workers=self.n_workers)
+        indices = iter(range(len(self.dataset)))
+
+        def submit():
+            # Submit the next file to the pool, return None when all files are submitted
+            i = next(indices, None)
+            if i is None:
+                return None
+            return executor.submit(self.dataset.__getitem__, i)
+
+        try:
+            if self.ordered:
+                pending = deque()
+                for _ in range(self.prefetch):
+                    future = submit()
+                    if future is None:
+                        break
+                    pending.append(future)
+
+                while pending:
+                    yield pending.popleft().result()
+                    future = submit()
+                    if future is not None:
+                        pending.append(future)
+
+            else:
+                pending = set()
+                for _ in range(self.prefetch):
+                    future = submit()
+                    if future is None:
+                        break
+                    pending.add(future)
+
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                        new_future = submit()
+                        if new_future is not None:
+                            pending.add(new_future)
+        finally:
+            # If the loop is interrupted, do not decode the remaining files
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# %% [markdown]
+# Preprocessing off the critical path
+# -----------------------------------
+#
+# Any function `PolyData -> object` can be used as `preprocess`. Here we normalize the shape in
+# the unit box (as in the rigid registration example), add control points and build a `Multiscale`
+# object. All of this runs in the workers, while the main thread is busy with the registration.
+
+# %%
+def preprocess(shape):
+    lims = torch.max(shape.points, dim=0).values - torch.min(shape.points, dim=0).values
+    shape.points -= torch.min(shape.points, dim=0).values
+    shape.points /= torch.max(lims)
+
+    shape.control_points = shape.bounding_grid(N=5, offset=0.05)
+    return sks.Multiscale(shape, ratios=[0.1, 0.01])
+
+
+dataset = ShapeDataset(files, preprocess=preprocess)
+template = dataset[0].at(ratio=0.01)
+
+def register(multiscale):
+    registration = sks.Registration(
+        model=sks.RigidMotion(),
+        loss=sks.NearestNeighborsLoss(),
+        n_iter=1,
+        verbose=False,
+    )
+    registration.fit(source=multiscale.at(ratio=0.01), target=template)
+    return registration.parameter_
+
+# %% [markdown]
+# Sequential loop vs prefetching loader
+# -------------------------------------
+#
+# Each file takes a noticeable time to read and decimate, while the registration runs at the coarsest
+# scale. With the loader, reading and preprocessing the next shapes overlaps with the registration of
+# the current one. The results are the same, as `ordered=True` preserves the order of the files.
+
+# %%
+start = time.perf_counter()
+parameters_sequential = [register(dataset[i]) for i in range(len(dataset))]
+time_sequential = time.perf_counter() - start
+
+start = time.perf_counter()
+loader = ShapeLoader(dataset, n_workers=4, prefetch=8)
+parameters_loader = [register(multiscale) for multiscale in loader]
+time_loader = time.perf_counter() - start
+
+print(f"Sequential loop: {time_sequential:.2f}s")
+print(f"ShapeLoader:     {time_loader:.2f}s")
+print(
+    "Same parameters:",
+    all(
+        torch.allclose(p1, p2)
+        for p1, p2 in zip(parameters_sequential, parameters_loader)
+    ),
+)
+
+# %% [markdown]
+# Unordered iteration
+# -------------------
+#
+# If the order does not matter (for instance to compute statistics on the dataset), `ordered=False`
+# yields the shapes as soon as they are decoded, so that a slow file does not block the others.
+
+# %%
+n_points = [multiscale.at(ratio=1).n_points for multiscale in ShapeLoader(dataset, ordered=False)]
+print(f"Mean number of points: {sum(n_points) / len(n_points)}")
+
+plotter = pv.Plotter(shape=(1, 4))
+for i, multiscale in enumerate(ShapeLoader(dataset, prefetch=2)):
+    if i == 4:
+        break
+    plotter.subplot(0, i)
+    plotter.add_mesh(multiscale.at(ratio=1).to_pyvista(), color="tan")
+    plotter.add_mesh(multiscale.at(ratio=1).control_points.to_pyvista(), color="green", opacity=0.5)
+plotter.show()
+
+for filename in files:
+    os.remove(filename)
+os.rmdir(folder)
@@ -0,0 +1,285 @@
+"""
+Rigid registration in closed form: Kabsch and ICP
+=================================================
+
+Rigid registration with `sks.RigidMotion` optimizes a rotation and a translation with LBFGS. For
+rigid-only workloads, this problem can be solved (almost) in closed form:
+
+- the Kabsch algorithm gives the optimal rotation and translation between two sets of paired points
+  (for instance landmarks),
+- the Iterative Closest Point (ICP) algorithm alternates between pairing each source point with its
+  nearest neighbor in the target and solving the paired problem.
+
+In this notebook, we implement both with a few vectorized torch operations and compare the result
+to the gradient-based registration of the previous example.
+"""
+
+# %% [markdown]
+# Load and preprocess data
+# ------------------------
+#
+# Same shapes and landmarks as in the rigid registration example.
+
+# %%
+import time
+
+import pyvista as pv
+import torch
+from pykeops.torch import LazyTensor
+from pyvista import examples
+
+import skshapes as sks
+
+color_1 = 'tan'
+color_2 = 'brown'
+
+shape1 = sks.PolyData(examples.download_woman().rotate_y(90))
+shape2 = sks.PolyData(examples.download_doorman())
+shape1.point_data.clear()
+shape2.point_data.clear()
+
+def bounds(shape):
+    return torch.max(shape.points, dim=0).values - torch.min(shape.points, dim=0).values
+
+for shape in [shape1, shape2]:
+    rescale = torch.max(bounds(shape))
+    shape.points -= torch.min(shape.points, dim=0).values
+    shape.points /= rescale
+
+shape1.landmark_indices = [4808, 147742, 1774]
+shape2.landmark_indices = [325, 2116, 1927]
+
+# %% [markdown]
+# Kabsch algorithm
+# ----------------
+#
+# Given paired points :math:`(x_i, y_i)`, the rotation :math:`R` and translation :math:`t` minimizing
+# :math:`\sum_i \|R x_i + t - y_i\|^2` are obtained from the SVD of the cross-covariance matrix
+# of the centered points. The sign correction ensures that :math:`R` is a rotation and not a reflection.
+
+# %%
+def kabsch(x, y):
+    """Rotation R and translation t such that x @ R.T + t is as close as possible to y."""
+    x_mean, y_mean = x.mean(dim=0), y.mean(dim=0)
+    covariance = (y - y_mean).T @ (x - x_mean)
+    U, _, Vh = torch.linalg.svd(covariance)
+    d = torch.sign(torch.linalg.det(U @ Vh))
+    D = torch.diag(torch.stack([torch.ones_like(d), torch.ones_like(d), d]))
+    R = U @ D @ Vh
+    t = y_mean - R @ x_mean
+    return R, t
+
+
+# %% [markdown]
+# Point-to-plane step
+# -------------------
+#
+# Point-to-plane ICP only penalizes the distance along the normal :math:`n_i` of the target, which
+# lets the source slide along the target surface and usually converges in fewer iterations.
+# The problem is linearized for small rotations :math:`R \simeq I + [\omega]_\times`, which gives a
+# :math:`6 \times 6` linear system in :math:`(\omega, t)`.
+
+# %%
+def point_to_plane(x, y, normals):
+    """Rotation R and translation t minimizing the sum of ((x @ R.T + t - y) . normals) ** 2."""
+    A = torch.cat([torch.linalg.cross(x, normals), normals], dim=1)
+    b = ((y - x) * normals).sum(dim=1)
+    solution = torch.linalg.solve(A.T @ A, A.T @ b)
+    omega, t = solution[:3], solution[3:]
+
+    # Rotation matrix from the rotation vector omega (exponential of the skew-symmetric matrix)
+    skew = torch.zeros(3, 3, dtype=x.dtype)
+    skew[0, 1], skew[0, 2], skew[1, 2] = -omega[2], omega[1], -omega[0]
+    skew = skew - skew.T
+    R = torch.linalg.matrix_exp(skew)
+    return R, t
+
+
+# %% [markdown]
+# Nearest neighbors
+# -----------------
+#
+# The pairing step of ICP is a nearest neighbor search. With KeOps, the distance matrix between
+# the source and the target points is never stored in memory, which makes the search fast even for the
+# 150k points of the target shape.
+
+# %%
+def nearest_neighbors(x, y):
+    """Index of the nearest neighbor in y of each point of x."""
+    x_i = LazyTensor(x[:, None, :].contiguous())
+    y_j = LazyTensor(y[None, :, :].contiguous())
+    D_ij = ((x_i - y_j) ** 2).sum(-1)
+    return D_ij.argmin(dim=1).view(-1)
+
+
+# %% [markdown]
+# Conversion to a `RigidMotion` parameter
+# ---------------------------------------
+#
+# `sks.RigidMotion` is parametrized by a `(2, 3)` tensor: a rotation vector (axis-angle) and a
+# translation, the rotation being applied around the center of mass of the source shape. We convert
+# :math:`(R, t)` to this representation, through unit quaternions for numerical stability.
+
+# %%
+def matrix_to_axis_angle(R):
+    """Rotation vector (axis * angle) of a rotation matrix."""
+    trace = R[0, 0] + R[1, 1] + R[2, 2]
+    candidates = torch.stack(
+        [
+            torch.stack([1 + trace, R[2, 1] - R[1, 2], R[0, 2] - R[2, 0], R[1, 0] - R[0, 1]]),
+            torch.stack([R[2, 1] - R[1, 2], 1 + 2 * R[0, 0] - trace, R[0, 1] + R[1, 0], R[0, 2] + R[2, 0]]),
+            torch.stack([R[0, 2] - R[2, 0], R[0, 1] + R[1, 0], 1 + 2 * R[1, 1] - trace, R[1, 2] + R[2, 1]]),
+            torch.stack([R[1, 0] - R[0, 1], R[0, 2] + R[2, 0], R[1, 2] + R[2, 1], 1 + 2 * R[2, 2] - trace]),
+        ]
+    )
+    # Use the best conditioned candidate (Shepperd's method)
+    diagonal = torch.stack([trace, R[0, 0], R[1, 1], R[2, 2]])
+    quaternion = candidates[torch.argmax(diagonal)]
+    quaternion = quaternion / torch.linalg.norm(quaternion)
+    if quaternion[0] < 0:
+        quaternion = -quaternion
+
+    sin_half_angle = torch.linalg.norm(quaternion[1:])
+    if sin_half_angle < 1e-8:
+        return 2 * quaternion[1:]
+    angle = 2 * torch.atan2(sin_half_angle, quaternion[0])
+    return angle * quaternion[1:] / sin_half_angle
+
+
+def to_rigid_motion_parameter(R, t, source):
+    center = source.points.mean(dim=0)
+    translation = t + R @ center - center
+    return torch.stack([matrix_to_axis_angle(R), translation])
+
+
+# %% [markdown]
+# The `ClosedFormRigidMotion` class
+# ---------------------------------
+#
+# - If both shapes have landmarks, the initial transformation is given by Kabsch on the landmarks,
+#   otherwise the centers of mass are aligned
+# - Then ICP iterations refine the alignment, with `mode="point_to_point"` (Kabsch on the pairs)
+#   or `mode="point_to_plane"` (requires the target to be a triangle mesh)
+# - As for `sks.Registration`, the result is available as `parameter_` and can be applied with
+#   `transform`
+
+# %%
+def has_landmarks(shape):
+    return shape.landmark_indices is not None and len(shape.landmark_indices) > 0
+
+
+class ClosedFormRigidMotion:
+    """Rigid registration with Kabsch initialization and ICP refinement."""
+
+    def __init__(self, n_iter=20, mode="point_to_plane", tol=1e-6, verbose=False):
+        if mode not in ["point_to_point", "point_to_plane"]:
+            raise ValueError("mode must be 'point_to_point' or 'point_to_plane'")
+        self.n_iter = n_iter
+        self.mode = mode
+        self.tol = tol
+        self.verbose = verbose
+
+    def fit(self, *, source, target):
+        x, y = source.points, target.points
+
+        if has_landmarks(source) and has_landmarks(target):
+            R, t = kabsch(source.landmark_points, target.landmark_points)
+        else:
+            R, t = torch.eye(3, dtype=x.dtype), y.mean(dim=0) - x.mean(dim=0)
+
+        if self.mode == "point_to_plane":
+            if target.triangles is None:
+                raise ValueError("point_to_plane mode requires a triangle mesh as target")
+            normals = torch.tensor(target.to_pyvista().point_normals, dtype=y.dtype)
+
+        # The error of each iterate is evaluated before the next update, so that the best
+        # (R, t) is returned even if an update increases the error
+        best_R, best_t, best_error = R, t, torch.inf
+        for i in range(self.n_iter + 1):
+            x_moved = x @ R.T + t
+            indices = nearest_neighbors(x_moved, y)
+            error = ((x_moved - y[indices]) ** 2).sum(dim=1).mean()
+            if self.verbose:
+                print(f"ICP iteration {i}, mean squared distance: {error:.3e}")
+            if error >= best_error - self.tol:
+                # No significant improvement: keep the best iterate
+                if error < best_error:
+                    best_R, best_t, best_error = R, t, error
+                break
+            best_R, best_t, best_error = R, t, error
+            if i == self.n_iter:
+                break
+
+            if self.mode == "point_to_point":
+                dR, dt = kabsch(x_moved, y[indices])
+            else:
+                dR, dt = point_to_plane(x_moved, y[indices], normals[indices])
+            R, t = dR @ R, dR @ t + dt
+
+        self.rotation_, self.translation_ = best_R, best_t
+        self.parameter_ = to_rigid_motion_parameter(best_R, best_t, source)
+        return self
+
+    def transform(self, *, source):
+        morph = source.copy()
+        morph.points = source.points @ self.rotation_.T + self.translation_
+        return morph
+
+
+# %% [markdown]
+# Comparison with the gradient-based registration
+# ------------------------------------------------
+#
+# We run the registration of the previous example (LBFGS with `NearestNeighborsLoss` and
+# `LandmarkLoss`) and the closed-form registration.
+
+# %%
+start = time.perf_counter()
+registration = sks.Registration(
+    model=sks.RigidMotion(),
+    loss=sks.NearestNeighborsLoss() + sks.LandmarkLoss(),
+    n_iter=2,
+    verbose=False,
+)
+registration.fit(source=shape2, target=shape1)
+morph_lbfgs = registration.transform(source=shape2)
+time_lbfgs = time.perf_counter() - start
+
+start = time.perf_counter()
+closed_form = ClosedFormRigidMotion(n_iter=20, mode="point_to_plane", verbose=True)
+closed_form.fit(source=shape2, target=shape1)
+morph_closed_form = closed_form.transform(source=shape2)
+time_closed_form = time.perf_counter() - start
+
+print(f"LBFGS registration:       {time_lbfgs:.3f}s")
+print(f"Closed-form registration: {time_closed_form:.3f}s")
+
+loss = sks.NearestNeighborsLoss()
+print(f"NearestNeighborsLoss (LBFGS):       {loss(morph_lbfgs, shape1):.3e}")
+print(f"NearestNeighborsLoss (closed form): {loss(morph_closed_form, shape1):.3e}")
+
+plotter = pv.Plotter(shape=(1, 2))
+plotter.subplot(0, 0)
+plotter.add_text("LBFGS", font_size=24)
+plotter.add_mesh(shape1.to_pyvista(), color=color_1)
+plotter.add_mesh(morph_lbfgs.to_pyvista(), color=color_2)
+plotter.subplot(0, 1)
+plotter.add_text("Kabsch + ICP", font_size=24)
+plotter.add_mesh(shape1.to_pyvista(), color=color_1)
+plotter.add_mesh(morph_closed_form.to_pyvista(), color=color_2)
+plotter.link_views()
+plotter.show()
+
+# %% [markdown]
+# Use the result with `RigidMotion`
+# ---------------------------------
+#
+# `parameter_` follows the convention of `sks.RigidMotion`, so it can be used with the `morph` method
+# of the model, for instance to warm-start a gradient-based registration with a more complex loss.
+
+# %%
+morph = sks.RigidMotion().morph(shape=shape2, parameter=closed_form.parameter_).morphed_shape
+print(
+    "Max distance between RigidMotion.morph and ClosedFormRigidMotion.transform:",
+    (morph.points - morph_closed_form.points).norm(dim=1).max().item(),
+)
@@ -0,0 +1,195 @@
+"""
+Compiling the registration criterion with `torch.compile`
+=========================================================
+
+For small shapes, such as the 11 points of the nonrigid registration example, most of the time
+spent in `Registration.fit` is python overhead: the integration loop of the model, the kernel
+evaluations and the loss are dispatched operation by operation.
+
+In this notebook, we write the criterion optimized by `Registration` as a function of the parameter,
+compile it with `torch.compile` (with a fallback when a component cannot be compiled) and measure
+the latency of one evaluation of the LBFGS closure for a small and a medium shape.
+"""
+
+# %% [markdown]
+# Data
+# ----
+#
+# - small: the 2D shapes of the nonrigid registration example
+# - medium: the Stanford bunny decimated to about 3500 points with `Multiscale`, rescaled to the size
+#   of the small shapes, and a smooth deformation of it
+
+# %%
+import math
+import time
+
+import torch
+from pyvista import examples
+
+import skshapes as sks
+
+
+def load_small():
+    sqrt2 = math.sqrt(2)
+    edges = torch.tensor(
+        [[0, 1], [1, 2], [2, 3], [1, 4], [4, 5], [1, 6], [6, 7], [7, 8], [6, 9], [9, 10]]
+    )
+    x1 = torch.tensor(
+        [
+            [4, 9], [4, 7], [2, 7], [1.95, 6], [6, 7], [6.05, 8], [4, 4],
+            [4 - sqrt2, 4 - sqrt2], [4 - sqrt2, 2 - sqrt2], [4 + sqrt2, 4 + sqrt2], [6 + sqrt2, 4 + sqrt2],
+        ],
+        dtype=torch.float32,
+    )
+    x2 = torch.tensor(
+        [
+            [4, 9], [4, 7], [2, 7], [1.95, 8], [6, 7], [6.05, 6], [4, 4],
+            [2, 4], [2 - sqrt2, 4 - sqrt2], [4 + sqrt2, 4 - sqrt2], [4 + sqrt2, 2 - sqrt2],
+        ],
+        dtype=torch.float32,
+    )
+    return sks.PolyData(x1, edges=edges), sks.PolyData(x2, edges=edges)
+
+
+def load_medium():
+    bunny = sks.Multiscale(sks.PolyData(examples.download_bunny()), ratios=[0.1]).at(ratio=0.1)
+    points = bunny.points - torch.min(bunny.points, dim=0).values
+    points = 10 * points / torch.max(points)
+    displacement = 0.5 * torch.sin(0.3 * points[:, [1, 2, 0]])
+    source = sks.PolyData(points=points, triangles=bunny.triangles)
+    target = sks.PolyData(points=points + displacement, triangles=bunny.triangles)
+    return source, target
+
+
+# %% [markdown]
+# The registration criterion as a function
+# ----------------------------------------
+#
+# `Registration` minimizes :math:`\text{loss}(\text{morph}(X), Y) + \lambda \times \text{reg}(\text{morph})`.
+# We write it as a function of the parameter only, which is what `torch.compile` needs.
+#
+# `compile_criterion` first tries to capture the whole criterion in a single graph
+# (`fullgraph=True`). If a component cannot be traced (for instance a KeOps reduction), it falls back
+# to a compilation with graph breaks, where the untraceable parts run eagerly, and finally to the
+# original function. The compilation happens at the first call, so we trigger it here with a forward
+# and backward pass. The criterion is first evaluated in eager mode, so that an error in the
+# criterion itself is raised, and only compilation errors lead to a fallback.
+
+# %%
+def make_criterion(model, loss, source, target, regularization_weight):
+    def criterion(parameter):
+        output = model.morph(shape=source, parameter=parameter, return_regularization=True)
+        return loss(output.morphed_shape, target) + regularization_weight * output.regularization
+
+    return criterion
+
+
+def compile_criterion(criterion, parameter):
+    criterion(parameter.clone().requires_grad_(True)).backward()
+
+    for options in [{"fullgraph": True}, {}]:
+        compiled = torch.compile(criterion, **options)
+        try:
+            compiled(parameter.clone().requires_grad_(True)).backward()
+        except torch._dynamo.exc.TorchDynamoException as error:
+            # Unsupported operations, and backend (inductor) failures, which are
+            # wrapped in BackendCompilerFailed
+            print(f"torch.compile({options}) failed with {type(error).__name__}")
+            torch._dynamo.reset()
+            continue
+        print(f"Criterion compiled with torch.compile({options})")
+        return compiled
+    print("Falling back to eager mode")
+    return criterion
+
+
+def fit(criterion, parameter, n_iter):
+    parameter = parameter.clone().requires_grad_(True)
+    optimizer = torch.optim.LBFGS([parameter])
+
+    def closure():
+        optimizer.zero_grad()
+        value = criterion(parameter)
+        value.backward()
+        return value
+
+    for _ in range(n_iter):
+        optimizer.step(closure)
+    return parameter.detach()
+
+
+def closure_latency(criterion, parameter, n_repeat=50):
+    parameter = parameter.clone().requires_grad_(True)
+    for _ in range(5):  # warmup
+        criterion(parameter).backward()
+    start = time.perf_counter()
+    for _ in range(n_repeat):
+        parameter.grad = None
+        criterion(parameter).backward()
+    return (time.perf_counter() - start) / n_repeat
+
+
+# %% [markdown]
+# Small shapes
+# ------------
+#
+# We use the same model and loss as in the nonrigid registration example. With control points,
+# the parameter of `ExtrinsicDeformation` is a momentum per control point, initialized at zero.
+
+# %%
+source, target = load_small()
+source.control_points = source.bounding_grid(N=10, offset=0.05)
+
+model = sks.ExtrinsicDeformation(
+    n_steps=8,
+    kernel=sks.GaussianKernel(sigma=1.0),
+    control_points=True,
+)
+loss = sks.L2Loss()
+regularization_weight = 0.1
+
+initial_parameter = torch.zeros_like(source.control_points.points)
+criterion = make_criterion(model, loss, source, target, regularization_weight)
+
+start = time.perf_counter()
+compiled_criterion = compile_criterion(criterion, initial_parameter)
+print(f"Compilation time: {time.perf_counter() - start:.1f}s")
+
+parameter_eager = fit(criterion, initial_parameter, n_iter=5)
+parameter_compiled = fit(compiled_criterion, initial_parameter, n_iter=5)
+print(f"Final criterion (eager):    {criterion(parameter_eager):.4e}")
+print(f"Final criterion (compiled): {criterion(parameter_compiled):.4e}")
+
+# %% [markdown]
+# Benchmark
+# ---------
+#
+# We measure the latency of one evaluation of the closure (forward and backward pass), which is
+# what LBFGS calls several times per iteration. The compilation time is paid once, at the first
+# call, and is not included.
+
+# %%
+def benchmark(name, source, target, model, loss, regularization_weight, initial_parameter):
+    criterion = make_criterion(model, loss, source, target, regularization_weight)
+    compiled_criterion = compile_criterion(criterion, initial_parameter)
+    eager = closure_latency(criterion, initial_parameter)
+    compiled = closure_latency(compiled_criterion, initial_parameter)
+    return name, source.n_points, eager, compiled
+
+
+results = [
+    benchmark("small", source, target, model, loss, regularization_weight, initial_parameter)
+]
+
+source, target = load_medium()
+source.control_points = source.bounding_grid(N=10, offset=0.05)
+results.append(
+    benchmark(
+        "medium", source, target, model, loss, regularization_weight,
+        torch.zeros_like(source.control_points.points),
+    )
+)
+
+print(f"{'shape':<8}{'n_points':>10}{'eager (ms)':>14}{'compiled (ms)':>16}{'speedup':>10}")
+for name, n_points, eager, compiled in results:
+    print(f"{name:<8}{n_points:>10}{1000 * eager:>14.2f}{1000 * compiled:>16.2f}{eager / compiled:>10.2f}")
@@ -0,0 +1,306 @@
+"""
+Stochastic registration: evaluating the loss on random subsets of points
+========================================================================
+
+When the target shape is large (the woman mesh of the rigid registration example has more than
+150k points), each evaluation of `NearestNeighborsLoss`, `L2Loss` or `OptimalTransportLoss` on all the
+points is expensive, while the first iterations of the optimization only need a rough estimate
+of the loss.
+
+In this notebook, we evaluate the loss on random subsets of points:
+
+- points of the source are sampled proportionally to their area, with a stratification that gives
+  one point per bin of equal area, so that the subsets are not concentrated in finely meshed regions
+- the size of the subsets grows geometrically from a hundred points to the number of points of the
+  source, which is reached for the last iterations, so that the optimization settles on the full
+  (area-weighted) loss
+- the parameter is optimized with an optimizer that tolerates noisy gradients, such as Adam
+"""
+
+# %% [markdown]
+# Load and preprocess data
+# ------------------------
+#
+# Same shapes and landmarks as in the rigid registration example.
+
+# %%
+import time
+
+import pyvista as pv
+import torch
+from pyvista import examples
+
+import skshapes as sks
+
+color_1 = 'tan'
+color_2 = 'brown'
+
+shape1 = sks.PolyData(examples.download_woman().rotate_y(90))
+shape2 = sks.PolyData(examples.download_doorman())
+shape1.point_data.clear()
+shape2.point_data.clear()
+
+def bounds(shape):
+    return torch.max(shape.points, dim=0).values - torch.min(shape.points, dim=0).values
+
+for shape in [shape1, shape2]:
+    rescale = torch.max(bounds(shape))
+    shape.points -= torch.min(shape.points, dim=0).values
+    shape.points /= rescale
+
+shape1.landmark_indices = [4808, 147742, 1774]
+shape2.landmark_indices = [325, 2116, 1927]
+
+print(f"Source: {shape2.n_points} points, target: {shape1.n_points} points")
+
+# %% [markdown]
+# Area-stratified sampling
+# ------------------------
+#
+# For a triangle mesh, the total area is split into `n_samples` bins of equal area, and one triangle is
+# drawn in each bin, with a probability proportional to its area within the bin. Then one of its
+# vertices is picked at random. The bins follow the order of the triangles in the mesh: they are
+# spatially coherent only if the mesh is ordered spatially (as meshes produced by most scanners and
+# remeshing tools). Otherwise, the stratification only reduces the variance of the area-proportional
+# sampling, and does not guarantee that the points are spread on the surface.
+#
+# As the probability of a vertex is proportional to the area of its neighborhood, a loss averaged over
+# the subset estimates an **area-weighted** loss (an integral over the surface of the source), not the
+# uniform mean over the vertices computed by `NearestNeighborsLoss` on the full shape. The
+# stochastic registration minimizes this area-weighted loss, and the results are evaluated with it
+# below. For point clouds and wireframes, points are drawn uniformly, and the estimate is unbiased
+# for the uniform mean.
+
+# %%
+class PointSampler:
+    """Draw random subsets of the points of a shape, with probabilities proportional to their area."""
+
+    def __init__(self, shape):
+        self.n_points = shape.n_points
+        if shape.triangles is not None:
+            self.triangles = shape.triangles
+            self.cumulative_areas = torch.cumsum(shape.triangle_areas, dim=0)
+        else:
+            self.triangles = None
+
+    def __call__(self, n_samples):
+        if self.triangles is None:
+            if n_samples >= self.n_points:
+                return torch.arange(self.n_points)
+            return torch.randperm(self.n_points)[:n_samples]
+        # One uniform draw in each of the n_samples bins of equal area
+        total_area = self.cumulative_areas[-1]
+        draws = (torch.arange(n_samples) + torch.rand(n_samples)) * total_area / n_samples
+        triangles = torch.searchsorted(self.cumulative_areas, draws).clamp(
+            max=len(self.triangles) - 1
+        )
+        corners = torch.randint(0, 3, (n_samples,))
+        return self.triangles[triangles, corners]
+
+
+def schedule(n_iter, start_size, max_size, growth=None, ramp=0.8):
+    """Sizes of the subsets, growing geometrically from start_size to max_size.
+
+    If growth is None, it is chosen so that max_size is reached after a fraction ramp of the iterations.
+    """
+    if growth is None:
+        n_ramp = max(1, ramp * (n_iter - 1))
+        growth = max(1, max_size / start_size) ** (1 / n_ramp)
+    return [min(max_size, int(start_size * growth**i)) for i in range(n_iter)]
+
+
+print("Subset sizes:", schedule(n_iter=12, start_size=100, max_size=shape2.n_points))
+
+sampler = PointSampler(shape1)
+plotter = pv.Plotter(shape=(1, 2))
+plotter.subplot(0, 0)
+plotter.add_text("Uniform sampling", font_size=24)
+plotter.add_points(shape1.points[torch.randperm(shape1.n_points)[:3000]].numpy(), color=color_1)
+plotter.subplot(0, 1)
+plotter.add_text("Area-stratified sampling", font_size=24)
+plotter.add_points(shape1.points[sampler(3000)].numpy(), color=color_1)
+plotter.link_views()
+plotter.show()
+
+# %% [markdown]
+# The `StochasticRegistration` class
+# ----------------------------------
+#
+# `StochasticRegistration` follows the interface of `sks.Registration`, with two differences:
+#
+# - `loss` is evaluated between a random subset of the points of the morphed source and the full
+#   target, with sizes given by the schedule, up to `max_fraction` of the source points (by default,
+#   all of them, reached after 80% of the iterations).
+#   Subsampling the target too would bias losses that match each source point with its nearest
+#   target point (`NearestNeighborsLoss`, `OptimalTransportLoss`): the nearest neighbor in a subset is
+#   farther away. Note that if a loss also matches target points with source points, this part is
+#   still evaluated on a subset of the source. If the loss needs paired points (`L2Loss`),
+#   `paired=True` uses the same indices for the source and the target
+# - `dense_loss` (optional) is evaluated on the full shapes, for cheap terms such as `LandmarkLoss`
+#
+# Each iteration is one step of a `torch.optim` optimizer (Adam by default) on a new subset. After
+# `fit`, `full_passes_` is the cost of the optimization, in number of evaluations of the loss on all the
+# source points.
+
+# %%
+class StochasticRegistration:
+    """Registration with a loss evaluated on random subsets of the source points."""
+
+    def __init__(
+        self,
+        *,
+        model,
+        loss,
+        dense_loss=None,
+        optimizer=torch.optim.Adam,
+        lr=0.01,
+        n_iter=100,
+        start_size=100,
+        growth=None,
+        max_fraction=1,
+        paired=False,
+        regularization_weight=0,
+        verbose=False,
+    ):
+        self.model = model
+        self.loss = loss
+        self.dense_loss = dense_loss
+        self.optimizer = optimizer
+        self.lr = lr
+        self.n_iter = n_iter
+        self.start_size = start_size
+        self.growth = growth
+        self.max_fraction = max_fraction
+        self.paired = paired
+        self.regularization_weight = regularization_weight
+        self.verbose = verbose
+
+    def fit(self, *, source, target, initial_parameter):
+        sampler = PointSampler(source)
+        max_size = max(1, int(self.max_fraction * source.n_points))
+        sizes = schedule(self.n_iter, self.start_size, max_size, self.growth)
+
+        parameter = initial_parameter.clone().requires_grad_(True)
+        optimizer = self.optimizer([parameter], lr=self.lr)
+
+        for i, size in enumerate(sizes):
+            indices = sampler(size)
+
+            optimizer.zero_grad()
+            output = self.model.morph(
+                shape=source, parameter=parameter, return_regularization=True
+            )
+            morphed = output.morphed_shape
+            if self.paired:
+                value = self.loss(
+                    sks.PolyData(points=morphed.points[indices]),
+                    sks.PolyData(points=target.points[indices]),
+                )
+            else:
+                value = self.loss(sks.PolyData(points=morphed.points[indices]), target)
+            if self.dense_loss is not None:
+                value = value + self.dense_loss(morphed, target)
+            value = value + self.regularization_weight * output.regularization
+            value.backward()
+            optimizer.step()
+
+            if self.verbose and i % 10 == 0:
+                print(f"Iteration {i}, subset size {size}, loss {value.item():.3e}")
+
+        self.parameter_ = parameter.detach()
+        self.full_passes_ = sum(sizes) / source.n_points
+        return self
+
+    def transform(self, *, source):
+        return self.model.morph(shape=source, parameter=self.parameter_).morphed_shape
+
+
+# %% [markdown]
+# Comparison at matched cost
+# --------------------------
+#
+# We run the stochastic registration, then the same optimization (Adam) with the loss evaluated on
+# full-size samples at each iteration, for the same cost: as many iterations as the number of full
+# passes of the stochastic run. The registration of the previous example (LBFGS, `n_iter=2`) is given
+# as a reference.
+#
+# The results are evaluated with the area-weighted loss minimized by the stochastic registration,
+# estimated on a fixed sample of ten times the number of source points, and with the uniform loss
+# `NearestNeighborsLoss() + LandmarkLoss()` on the full shapes.
+
+# %%
+initial_parameter = torch.zeros(2, 3)  # RigidMotion in 3D: rotation vector and translation
+
+start = time.perf_counter()
+stochastic_registration = StochasticRegistration(
+    model=sks.RigidMotion(),
+    loss=sks.NearestNeighborsLoss(),
+    dense_loss=sks.LandmarkLoss(),
+    lr=0.01,
+    n_iter=150,
+    start_size=100,
+    verbose=True,
+)
+stochastic_registration.fit(source=shape2, target=shape1, initial_parameter=initial_parameter)
+morph_stochastic = stochastic_registration.transform(source=shape2)
+time_stochastic = time.perf_counter() - start
+budget = stochastic_registration.full_passes_
+print(f"Cost of the stochastic registration: {budget:.1f} full passes")
+
+start = time.perf_counter()
+full_adam_registration = StochasticRegistration(
+    model=sks.RigidMotion(),
+    loss=sks.NearestNeighborsLoss(),
+    dense_loss=sks.LandmarkLoss(),
+    lr=0.01,
+    n_iter=max(1, round(budget)),
+    start_size=shape2.n_points,
+)
+full_adam_registration.fit(source=shape2, target=shape1, initial_parameter=initial_parameter)
+morph_full_adam = full_adam_registration.transform(source=shape2)
+time_full_adam = time.perf_counter() - start
+
+start = time.perf_counter()
+registration = sks.Registration(
+    model=sks.RigidMotion(),
+    loss=sks.NearestNeighborsLoss() + sks.LandmarkLoss(),
+    n_iter=2,
+    verbose=False,
+)
+registration.fit(source=shape2, target=shape1)
+morph_lbfgs = registration.transform(source=shape2)
+time_lbfgs = time.perf_counter() - start
+
+evaluation_indices = PointSampler(shape2)(10 * shape2.n_points)
+
+def area_weighted_loss(morph):
+    return sks.NearestNeighborsLoss()(
+        sks.PolyData(points=morph.points[evaluation_indices]), shape1
+    ) + sks.LandmarkLoss()(morph, shape1)
+
+uniform_loss = sks.NearestNeighborsLoss() + sks.LandmarkLoss()
+
+for title, morph, duration in [
+    (f"Stochastic loss, Adam ({budget:.1f} full passes)", morph_stochastic, time_stochastic),
+    (f"Full loss, Adam ({full_adam_registration.full_passes_:.0f} full passes)", morph_full_adam, time_full_adam),
+    ("Full loss, LBFGS (reference)", morph_lbfgs, time_lbfgs),
+]:
+    print(
+        f"{title:<40} {duration:6.2f}s, area-weighted loss {area_weighted_loss(morph):.3e},"
+        f" uniform loss {uniform_loss(morph, shape1):.3e}"
+    )
+
+plotter = pv.Plotter(shape=(1, 3))
+for i, (title, morph) in enumerate(
+    [
+        ("Stochastic loss, Adam", morph_stochastic),
+        ("Full loss, Adam", morph_full_adam),
+        ("Full loss, LBFGS", morph_lbfgs),
+    ]
+):
+    plotter.subplot(0, i)
+    plotter.add_text(title, font_size=24)
+    plotter.add_mesh(shape1.to_pyvista(), color=color_1)
+    plotter.add_mesh(morph.to_pyvista(), color=color_2)
+plotter.link_views()
+plotter.show()
@@ -0,0 +1,311 @@
+"""
+Compact storage for many signals
+================================
+
+The `PolyData` example stores signals one by one in `point_data`, `edge_data` and `triangle_data`.
+Each assignment is validated separately and each signal is a separate tensor. For meshes with dozens
+of features, this notebook shows a columnar alternative:
+
+- signals with the same dtype are stored side by side in one contiguous block
+- many signals are inserted or replaced at once, with a single validation
+- floating point signals can be stored in reduced precision (`float16` or `int8`), and are
+  decompressed on access
+- the floating point signals are propagated through `Multiscale` as a single signal, and the store is
+  saved next to the mesh
+"""
+
+# %% [markdown]
+# The `SignalStore` class
+# -----------------------
+#
+# A `SignalStore` holds signals with the same first dimension `n` (`n_points`, `n_edges` or
+# `n_triangles`). Each signal is flattened to `(n, width)` and its columns are placed in the block
+# corresponding to its storage dtype. The layout records where each signal lives, its original dtype
+# and its original shape.
+#
+# With `quantization="int8"`, each column is mapped affinely on `[-128, 127]`, the scale and offset of
+# the columns being stored alongside the block.
+
+# %%
+import math
+import os
+import time
+
+import pyvista as pv
+import torch
+
+import skshapes as sks
+
+
+class SignalStore:
+    """Columnar storage for signals sharing the same first dimension."""
+
+    def __init__(self, n, quantization=None):
+        if quantization not in [None, "float16", "int8"]:
+            raise ValueError("quantization must be None, 'float16' or 'int8'")
+        self.n = n
+        self.quantization = quantization
+        self._blocks = {}  # storage key -> (n, width) tensor
+        self._scales = {}  # storage key -> (scale, offset) of the columns, for int8
+        self._layout = {}  # name -> (storage key, start, stop, dtype, shape)
+
+    def _storage_key(self, dtype):
+        # Floating point signals are grouped according to the quantization mode,
+        # other signals are stored with their own dtype
+        if not dtype.is_floating_point or self.quantization is None:
+            return dtype
+        return torch.float16 if self.quantization == "float16" else "int8_quantized"
+
+    def _columns(self, key, start, stop):
+        # Decompressed columns start:stop of a block, as a (n, stop - start) tensor. The block is
+        # sliced before decompression, so that only the requested columns are allocated.
+        columns = self._blocks[key][:, start:stop]
+        if key == "int8_quantized":
+            scale, offset = self._scales[key]
+            return (columns.float() + 128) * scale[start:stop] + offset[start:stop]
+        return columns
+
+    def _encode(self, key, columns):
+        # Columns in their storage format, and their (scale, offset) for int8
+        if key == "int8_quantized":
+            columns = columns.float()
+            offset = columns.min(dim=0).values
+            scale = (columns.max(dim=0).values - offset).clamp(min=1e-12) / 255
+            return torch.round((columns - offset) / scale - 128).to(torch.int8), (scale, offset)
+        return columns.to(key), None
+
+    def _rebuild(self, keys, signals, removed=()):
+        # Rebuild the blocks of the given storage keys, with one concatenation per block.
+        # Stored columns are reused as they are (int8 columns are not quantized again),
+        # and the blocks of the other storage keys are not touched.
+        groups = {key: [] for key in keys}
+        for name, (key, start, stop, dtype, shape) in self._layout.items():
+            if key in groups and name not in signals and name not in removed:
+                scales = None
+                if key == "int8_quantized":
+                    scale, offset = self._scales[key]
+                    scales = (scale[start:stop], offset[start:stop])
+                groups[key].append((name, self._blocks[key][:, start:stop], scales, dtype, shape))
+        for name, value in signals.items():
+            key = self._storage_key(value.dtype)
+            stored, scales = self._encode(key, value.reshape(self.n, -1))
+            groups[key].append((name, stored, scales, value.dtype, value.shape[1:]))
+
+        self._layout = {
+            name: entry
+            for name, entry in self._layout.items()
+            if entry[0] not in groups and name not in signals
+        }
+        for key, group in groups.items():
+            self._blocks.pop(key, None)
+            self._scales.pop(key, None)
+            if not group:
+                continue
+            start = 0
+            for name, stored, _, dtype, shape in group:
+                stop = start + stored.shape[1]
+                self._layout[name] = (key, start, stop, dtype, shape)
+                start = stop
+            self._blocks[key] = torch.cat([stored for _, stored, _, _, _ in group], dim=1).contiguous()
+            if key == "int8_quantized":
+                self._scales[key] = (
+                    torch.cat([scales[0] for _, _, scales, _, _ in group]),
+                    torch.cat([scales[1] for _, _, scales, _, _ in group]),
+                )
+
+    def update(self, signals):
+        """Insert or replace several signals at once."""
+        for name, value in signals.items():
+            if not isinstance(value, torch.Tensor) or value.dim() < 1 or value.shape[0] != self.n:
+                raise ValueError(
+                    f"Signal {name} must be a tensor with first dimension {self.n}"
+                )
+
+        # Only the blocks receiving a new signal, or losing a replaced one, are rebuilt
+        keys = {self._storage_key(value.dtype) for value in signals.values()}
+        keys |= {self._layout[name][0] for name in signals if name in self._layout}
+        self._rebuild(keys, signals)
+
+    def __setitem__(self, name, value):
+        self.update({name: value})
+
+    def __getitem__(self, name):
+        key, start, stop, dtype, shape = self._layout[name]
+        columns = self._columns(key, start, stop)
+        return columns.to(dtype).reshape(self.n, *shape)
+
+    def __delitem__(self, name):
+        self._rebuild({self._layout[name][0]}, {}, removed={name})
+
+    def __contains__(self, name):
+        return name in self._layout
+
+    def __len__(self):
+        return len(self._layout)
+
+    def keys(self):
+        return self._layout.keys()
+
+    @property
+    def nbytes(self):
+        blocks = sum(block.nbytes for block in self._blocks.values())
+        scales = sum(scale.nbytes + offset.nbytes for scale, offset in self._scales.values())
+        return blocks + scales
+
+    def floating_keys(self):
+        return [name for name in self.keys() if self._layout[name][3].is_floating_point]
+
+    def pack(self):
+        """The floating point signals decompressed in a single (n, width) float32 tensor."""
+        if not self.floating_keys():
+            raise ValueError("The store has no floating point signal to pack")
+        return torch.cat(
+            [self[name].reshape(self.n, -1).to(torch.float32) for name in self.floating_keys()],
+            dim=1,
+        )
+
+    def unpack(self, packed, quantization="same"):
+        """Store with the floating point signals of self, read from a packed tensor with another first dimension."""
+        if quantization == "same":
+            quantization = self.quantization
+        store = SignalStore(packed.shape[0], quantization=quantization)
+        signals, start = {}, 0
+        for name in self.floating_keys():
+            _, _, _, dtype, shape = self._layout[name]
+            stop = start + math.prod(shape)
+            signals[name] = packed[:, start:stop].to(dtype).reshape(packed.shape[0], *shape)
+            start = stop
+        store.update(signals)
+        return store
+
+    def save(self, filename):
+        torch.save(
+            {
+                "n": self.n,
+                "quantization": self.quantization,
+                "blocks": self._blocks,
+                "scales": self._scales,
+                "layout": self._layout,
+            },
+            filename,
+        )
+
+    @classmethod
+    def load(cls, filename):
+        state = torch.load(filename)
+        store = cls(state["n"], quantization=state["quantization"])
+        store._blocks = state["blocks"]
+        store._scales = state["scales"]
+        store._layout = state["layout"]
+        return store
+
+
+# %% [markdown]
+# Many signals on a mesh
+# ----------------------
+#
+# We create 30 signals per edge, each of shape `(n_edges, 3, 3)` as `signal_edges` in the
+# `PolyData` example, and compare the assignment one by one in `edge_data` with a single
+# `update` of a `SignalStore`.
+
+# %%
+mesh = sks.PolyData("data/mesh044.ply")
+cpos = [(-1.6657788922829617, 7.472045340108491, 3.9439767221656665),
+ (0.8380894707515836, -0.003572508692741394, -0.002311795949935913),
+ (0.9587598899863243, 0.2457800580099367, 0.14272924170625823)]
+
+n_signals = 30
+edge_signals = {f"signal_edges_{i}": torch.rand(mesh.n_edges, 3, 3) for i in range(n_signals)}
+edge_signals["lengths"] = mesh.edge_lengths
+
+start = time.perf_counter()
+for name, value in edge_signals.items():
+    mesh.edge_data[name] = value
+time_edge_data = time.perf_counter() - start
+
+start = time.perf_counter()
+edge_store = SignalStore(mesh.n_edges)
+edge_store.update(edge_signals)
+time_store = time.perf_counter() - start
+
+print(f"edge_data, one assignment per signal: {1000 * time_edge_data:.2f}ms")
+print(f"SignalStore, single update:           {1000 * time_store:.2f}ms")
+print("Same signals:", all(torch.equal(edge_store[name], edge_signals[name]) for name in edge_signals))
+
+# %% [markdown]
+# Reduced precision
+# -----------------
+#
+# With `quantization="float16"` the memory is halved, with `quantization="int8"` it is divided by
+# four. Signals are decompressed to their original dtype when accessed.
+
+# %%
+for quantization in [None, "float16", "int8"]:
+    store = SignalStore(mesh.n_edges, quantization=quantization)
+    store.update(edge_signals)
+    error = max(
+        (store[name] - edge_signals[name]).abs().max().item() for name in edge_signals
+    )
+    print(f"quantization={quantization!s:<8} {store.nbytes / 1e6:6.2f}MB, max error {error:.1e}")
+
+# %% [markdown]
+# Multiscale
+# ----------
+#
+# Floating point signals are propagated through `Multiscale` as a single packed signal: one
+# propagation instead of one per signal. The store at a coarser scale is rebuilt with `unpack`, with
+# the same names, dtypes and shapes. The packed signal is an uncompressed copy of the store: it is
+# removed from the `point_data` of every scale once the stores are rebuilt.
+#
+# Integer and boolean signals (labels, masks) are not packed: averaging them across a cluster of points
+# and casting the result back would silently truncate them. They must be transferred separately,
+# with a policy suited to them.
+
+# %%
+point_store = SignalStore(mesh.n_points, quantization="float16")
+point_store.update(
+    {f"coordinate_{i}": mesh.points[:, i] for i in range(3)}
+    | {f"feature_{i}": torch.rand(mesh.n_points, 4) for i in range(20)}
+    | {"label": (mesh.points[:, 0] > mesh.points[:, 0].mean()).long()}
+)
+
+mesh.point_data["packed"] = point_store.pack()
+multimesh = sks.Multiscale(mesh, ratios=[0.5, 0.1])
+multimesh.propagate(signal_name="packed", from_ratio=1)
+
+stores = {}
+for ratio in [1, 0.5, 0.1]:
+    level = multimesh.at(ratio=ratio)
+    stores[ratio] = point_store.unpack(level.point_data["packed"])
+    del level.point_data["packed"]
+if "packed" in mesh.point_data:
+    del mesh.point_data["packed"]
+
+coarse_mesh = multimesh.at(ratio=0.1)
+coarse_store = stores[0.1]
+coarse_mesh.point_data["coordinate_0"] = coarse_store["coordinate_0"]
+print(f"{len(coarse_store)} signals at ratio 0.1, {coarse_store.nbytes / 1e3:.1f}kB")
+print("label propagated:", "label" in coarse_store)
+
+plotter = pv.Plotter(shape=(1, 2))
+plotter.subplot(0, 0)
+mesh.point_data["coordinate_0"] = point_store["coordinate_0"]
+plotter.add_mesh(mesh.to_pyvista(), scalars="coordinate_0")
+plotter.camera_position = cpos
+plotter.subplot(0, 1)
+plotter.add_mesh(coarse_mesh.to_pyvista(), scalars="coordinate_0")
+plotter.camera_position = cpos
+plotter.show()
+
+# %% [markdown]
+# Save and load
+# -------------
+#
+# As control points, the store is saved separately from the mesh, in its compressed form.
+
+# %%
+filename_store = "tmp_point_store.pt"
+point_store.save(filename_store)
+loaded_store = SignalStore.load(filename_store)
+print("Same signals:", all(torch.equal(loaded_store[name], point_store[name]) for name in point_store.keys()))
+os.remove(filename_store)
@@ -0,0 +1,253 @@
+"""
+Setting landmarks on large meshes
+=================================
+
+`sks.LandmarkSetter` renders and picks on the full resolution mesh. With the 150k points of the
+woman mesh of the rigid registration example, or with scans of several millions of points, the
+interaction becomes slow.
+
+In this notebook, we display a decimated version of the mesh, computed with `Multiscale`, in the
+`LandmarkSetter`, and snap the selected points back to vertices of the full resolution mesh with a
+spatial index (a regular grid), built once.
+"""
+
+# %% [markdown]
+# A grid spatial index
+# --------------------
+#
+# The points are sorted by the cell of a regular grid that contains them. The nearest neighbor of a
+# query point is searched in the shells of cells at growing (Chebyshev) distance :math:`r` from the
+# cell of the query, starting at the distance from the query to the grid, each shell being visited
+# once. As the query belongs to its cell, all the points closer than :math:`r` times the size of a cell
+# are in the visited cells: the search stops as soon as the best candidate is that close.
+# The index works with 2D and 3D shapes.
+
+# %%
+import time
+
+import pyvista as pv
+import torch
+from pyvista import examples
+
+import skshapes as sks
+
+
+class GridIndex:
+    """Nearest neighbor search in a set of points, with a regular grid."""
+
+    def __init__(self, points, points_per_cell=4):
+        if points.dim() != 2 or points.shape[1] not in [2, 3]:
+            raise ValueError("GridIndex expects 2D or 3D points, as a (n_points, 2 or 3) tensor")
+        self.points = points
+        self.origin = points.min(dim=0).values
+        extent = points.max(dim=0).values - self.origin
+        self.cell_size = self._cell_size(extent, len(points), points_per_cell)
+
+        cells = self._cells(points)
+        self.dims = cells.max(dim=0).values + 1
+        keys = self._keys(cells)
+        self.order = torch.argsort(keys)
+        self.unique_keys, self.counts = torch.unique_consecutive(
+            keys[self.order], return_counts=True
+        )
+        self.starts = torch.cumsum(self.counts, dim=0) - self.counts
+
+    @staticmethod
+    def _cell_size(extent, n_points, points_per_cell):
+        # The size of the cells is estimated from the extents that are larger than a cell, so that
+        # planar or near-planar shapes do not lead to microscopic cells
+        if extent.max() == 0:
+            return torch.tensor(1.0)
+        active = extent > 0
+        for _ in range(len(extent)):
+            cell_size = (extent[active].prod() * points_per_cell / n_points) ** (1 / active.sum())
+            if ((extent > cell_size) == active).all() or not (extent > cell_size).any():
+                break
+            active = extent > cell_size
+        # Never more cells along an axis than points
+        return torch.maximum(cell_size, extent.max() / n_points)
+
+    def _cells(self, points):
+        return torch.floor((points - self.origin) / self.cell_size).long()
+
+    def _keys(self, cells):
+        keys = cells[:, 0]
+        for i in range(1, cells.shape[1]):
+            keys = keys * self.dims[i] + cells[:, i]
+        return keys
+
+    def _shell(self, cell, radius):
+        # Cells of the grid at Chebyshev distance exactly radius from cell. Each face of the shell is
+        # enumerated once, restricted to the cells inside the grid.
+        if radius == 0:
+            return cell[None, :]
+        low = (-cell).clamp(min=-radius).tolist()
+        high = (self.dims - 1 - cell).clamp(max=radius).tolist()
+        faces = []
+        for i in range(len(self.dims)):
+            for side in [-radius, radius]:
+                if not low[i] <= side <= high[i]:
+                    continue
+                ranges = []
+                for j in range(len(self.dims)):
+                    if j == i:
+                        ranges.append(torch.tensor([side]))
+                    elif j < i:
+                        # Cells with |offset_j| == radius belong to the face of axis j
+                        ranges.append(torch.arange(max(low[j], -radius + 1), min(high[j], radius - 1) + 1))
+                    else:
+                        ranges.append(torch.arange(low[j], high[j] + 1))
+                if all(len(r) > 0 for r in ranges):
+                    faces.append(torch.cartesian_prod(*ranges).reshape(-1, len(self.dims)))
+        if not faces:
+            return torch.empty(0, len(self.dims), dtype=torch.long)
+        return cell + torch.cat(faces)
+
+    def _points_in(self, cells):
+        # Indices of the points in the given cells
+        keys = self._keys(cells)
+        positions = torch.searchsorted(self.unique_keys, keys).clamp(max=len(self.unique_keys) - 1)
+        positions = positions[self.unique_keys[positions] == keys]
+        starts, counts = self.starts[positions], self.counts[positions]
+
+        local = torch.arange(counts.sum()) - torch.repeat_interleave(
+            torch.cumsum(counts, dim=0) - counts, counts
+        )
+        return self.order[torch.repeat_interleave(starts, counts) + local]
+
+    def query(self, queries):
+        """Index of the nearest point of each query point."""
+        indices = []
+        for query in queries:
+            cell = self._cells(query[None, :])[0]
+            # A query outside the grid starts at its distance to the grid
+            radius = int((cell - torch.clamp(cell, min=torch.zeros_like(cell), max=self.dims - 1)).abs().max())
+            max_radius = radius + int(self.dims.max())
+            best, best_distance = None, torch.inf
+            while True:
+                candidates = self._points_in(self._shell(cell, radius))
+                if len(candidates) > 0:
+                    distances = (self.points[candidates] - query).norm(dim=1)
+                    i = torch.argmin(distances)
+                    if distances[i] < best_distance:
+                        best, best_distance = candidates[i], distances[i]
+                # The cells not visited yet are farther than radius * cell_size from the query
+                if best is not None and (best_distance <= radius * self.cell_size or radius >= max_radius):
+                    indices.append(best)
+                    break
+                radius += 1
+        return torch.stack(indices)
+
+
+# %% [markdown]
+# The `LODLandmarkSetter` class
+# -----------------------------
+#
+# - At initialization, a `Multiscale` object with roughly `n_points` points at the coarse scale
+#   and a `GridIndex` of the full resolution points are computed for each shape
+# - `start` opens the `LandmarkSetter` on the coarse shapes, then `snap` sets the landmarks of the
+#   full resolution shapes, as the nearest vertices of the selected points
+#
+# Landmarks already defined on the shapes are propagated to the coarse scale by `Multiscale`, and
+# appear in the `LandmarkSetter`.
+
+# %%
+class LODLandmarkSetter:
+    """LandmarkSetter displaying a decimated version of the shapes."""
+
+    def __init__(self, shapes, n_points=5000):
+        self.shapes = list(shapes) if isinstance(shapes, (list, tuple)) else [shapes]
+        self.lods, self.indices = [], []
+        for shape in self.shapes:
+            ratio = min(1, n_points / shape.n_points)
+            self.lods.append(sks.Multiscale(shape, ratios=[ratio]).at(ratio=ratio))
+            self.indices.append(GridIndex(shape.points))
+
+    def start(self):
+        sks.LandmarkSetter(self.lods if len(self.lods) > 1 else self.lods[0]).start()
+        self.snap()
+
+    def snap(self):
+        for shape, lod, index in zip(self.shapes, self.lods, self.indices):
+            if lod.landmark_indices is None or len(lod.landmark_indices) == 0:
+                continue
+            shape.landmark_indices = index.query(lod.landmark_points).tolist()
+
+
+# %% [markdown]
+# Load data
+# ---------
+
+# %%
+shape = sks.PolyData(examples.download_woman().rotate_y(90))
+shape.point_data.clear()
+
+start = time.perf_counter()
+setter = LODLandmarkSetter(shape, n_points=5000)
+print(f"Preprocessing: {time.perf_counter() - start:.2f}s")
+print(f"Full resolution: {shape.n_points} points, displayed: {setter.lods[0].n_points} points")
+
+# %% [markdown]
+# Select landmarks
+# ----------------
+#
+# In the gallery, we simulate the selection of the landmarks of the rigid registration example on
+# the coarse mesh.
+
+# %%
+reference_landmarks = [4808, 147742, 1774]
+
+if not pv.BUILDING_GALLERY:
+    # If not in the gallery, we can use vedo to open the landmark setter
+    # Setting the default backend to vtk is necessary when running in a notebook
+    import vedo
+    vedo.settings.default_backend= 'vtk'
+    setter.start()
+else:
+    # Select the landmarks manually on the coarse mesh
+    lod = setter.lods[0]
+    lod.landmark_indices = GridIndex(lod.points).query(shape.points[reference_landmarks]).tolist()
+    setter.snap()
+
+print(f"Landmarks on the coarse mesh: {setter.lods[0].landmark_indices}")
+print(f"Landmarks on the full mesh: {shape.landmark_indices}")
+
+# %% [markdown]
+# Snapping time
+# -------------
+#
+# The spatial index answers a query in a time that depends on the number of points in a few cells,
+# not on the size of the mesh, as a brute force search does.
+
+# %%
+queries = setter.lods[0].points[:100]
+
+start = time.perf_counter()
+indices_grid = setter.indices[0].query(queries)
+time_grid = time.perf_counter() - start
+
+start = time.perf_counter()
+indices_brute_force = torch.cdist(queries, shape.points).argmin(dim=1)
+time_brute_force = time.perf_counter() - start
+
+print(f"Grid index:  {1000 * time_grid / len(queries):.3f}ms per query")
+print(f"Brute force: {1000 * time_brute_force / len(queries):.3f}ms per query")
+print(
+    "Same distances:",
+    torch.allclose(
+        (shape.points[indices_grid] - queries).norm(dim=1),
+        (shape.points[indices_brute_force] - queries).norm(dim=1),
+    ),
+)
+
+plotter = pv.Plotter(shape=(1, 2))
+plotter.subplot(0, 0)
+plotter.add_text(f"Displayed: {setter.lods[0].n_points} points", font_size=16)
+plotter.add_mesh(setter.lods[0].to_pyvista(), color="tan")
+plotter.add_points(setter.lods[0].landmark_points.numpy(), color="red", point_size=15, render_points_as_spheres=True)
+plotter.subplot(0, 1)
+plotter.add_text(f"Full resolution: {shape.n_points} points", font_size=16)
+plotter.add_mesh(shape.to_pyvista(), color="tan")
+plotter.add_points(shape.landmark_points.numpy(), color="red", point_size=15, render_points_as_spheres=True)
+plotter.link_views()
+plotter.show()